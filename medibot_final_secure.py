@@ -8,224 +8,596 @@
 # - Main control panel with "أدويتي" submenu (عرض، إضافة، تعديل، حذف)
 # - "رجوع" زر في كل مرحلة ليعود للقائمة السابقة
 # - APScheduler reminders and optional Azure TTS voice reminder
-# - Saves state to data.json (UTF-8)
+# - Saves state to SQLite (medibot.db, WAL mode); imports an old data.json once
 #
 # Env variables:
 # BOT_TOKEN (required)
-# WEBHOOK_MODE = "poll" or "webhook" (default "poll")
+# WEBHOOK_MODE = "poll" or "webhook" (default "webhook" when WEBHOOK_URL_BASE is set, else "poll")
 # WEBHOOK_URL_BASE required for webhook mode (https://...)
+# WSGI_THREADS, UPDATE_WORKERS = webhook server threads / per-chat update lanes (default 16)
 # Optional for Azure TTS:
-# AZURE_TTS_KEY, AZURE_TTS_REGION
+# AZURE_TTS_KEY, AZURE_TTS_REGION (voice notes are cached under tts_cache/ for 7 days)
 #
-# Requirements (see bottom): pyTelegramBotAPI Flask APScheduler python-dotenv requests
+# Requirements (see bottom): pyTelegramBotAPI Flask APScheduler python-dotenv requests waitress orjson
 
 import os
-import json
+import sys
+import re
+import orjson
+import queue
+import atexit
+import sqlite3
 import threading
 import traceback
-from datetime import datetime
-from functools import partial
+import weakref
+import secrets
+import hashlib
+from dataclasses import dataclass
+from functools import lru_cache, wraps
 from pathlib import Path
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Flask, request
 import telebot
-from telebot import types
+from telebot import apihelper, types
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
+from waitress import serve
 
 # Optional import for HTTP requests (for Azure TTS)
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # -----------------------
 # Load environment
 # -----------------------
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN env required")
+@dataclass(frozen=True, slots=True)
+class Config:
+    bot_token: str
+    webhook_mode: str  # "poll" or "webhook"
+    webhook_url: str | None
+    azure_tts_key: str | None
+    azure_tts_region: str | None
+    wsgi_threads: int
+    update_workers: int
+    port: int
 
-WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "poll").lower()  # "poll" or "webhook"
-WEBHOOK_URL_BASE = os.getenv("WEBHOOK_URL_BASE")  # e.g. https://xyz.ngrok.io
-if WEBHOOK_MODE == "webhook" and not WEBHOOK_URL_BASE:
-    raise RuntimeError("WEBHOOK_URL_BASE required when WEBHOOK_MODE=webhook")
-WEBHOOK_URL = f"{WEBHOOK_URL_BASE.rstrip('/')}/{BOT_TOKEN}" if WEBHOOK_URL_BASE else None
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Read the environment once; later calls return the same Config."""
+    if not os.getenv("BOT_TOKEN"):
+        load_dotenv()  # skip the .env file scan when the env is already provisioned
+    bot_token = os.getenv("BOT_TOKEN")
+    if not bot_token:
+        raise RuntimeError("BOT_TOKEN env required")
 
-AZURE_TTS_KEY = os.getenv("AZURE_TTS_KEY")  # optional
-AZURE_TTS_REGION = os.getenv("AZURE_TTS_REGION")  # optional like "eastus"
+    webhook_url_base = os.getenv("WEBHOOK_URL_BASE")  # e.g. https://xyz.ngrok.io
+    # webhook is the default whenever a public URL is configured; "poll" is for local dev
+    webhook_mode = os.getenv("WEBHOOK_MODE", "webhook" if webhook_url_base else "poll").lower()
+    if webhook_mode == "webhook" and not webhook_url_base:
+        raise RuntimeError("WEBHOOK_URL_BASE required when WEBHOOK_MODE=webhook")
 
-DATA_FILE = "data.json"
-DATA_LOCK = threading.Lock()
+    return Config(
+        bot_token=bot_token,
+        webhook_mode=webhook_mode,
+        webhook_url=f"{webhook_url_base.rstrip('/')}/{bot_token}" if webhook_url_base else None,
+        azure_tts_key=os.getenv("AZURE_TTS_KEY"),  # optional
+        azure_tts_region=os.getenv("AZURE_TTS_REGION"),  # optional like "eastus"
+        wsgi_threads=int(os.getenv("WSGI_THREADS", "16")),
+        update_workers=int(os.getenv("UPDATE_WORKERS", "16")),
+        port=int(os.getenv("PORT", "5000")),
+    )
+
+CFG = get_config()
+
+DB_FILE = "medibot.db"
+# pre-SQLite storage, imported once into an empty DB_FILE
+LEGACY_DATA_FILE = "data.json"
+# synthesized reminders, keyed by sha256 of the SSML
+TTS_CACHE_DIR = Path("tts_cache")
+TTS_CACHE_TTL = 7 * 24 * 3600  # seconds
 
 # -----------------------
 # Init
 # -----------------------
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+# in webhook mode updates are dispatched by our own per-chat workers (see
+# dispatch_update), so telebot must run the handlers inline
+bot = telebot.TeleBot(CFG.bot_token, threaded=(CFG.webhook_mode != "webhook"))
+# One pooled keep-alive session shared by every thread's Telegram API calls,
+# so the TLS connection to api.telegram.org stays warm between messages.
+telegram_session = requests.Session()
+telegram_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=Retry(total=3, backoff_factor=0.2)))
+apihelper.session = telegram_session
 app = Flask(__name__)
 scheduler = BackgroundScheduler()
 scheduler.start()
 
-# in-memory data; persisted to DATA_FILE
+# in-memory data; persisted to DB_FILE except the EPHEMERAL_FIELDS
 # structure:
 # data = {
-#   "<user_id>": {
-#       "step": "...",
+#   <user_id>: {  (int chat id; stringified only in the DB)
+#       "step": "...", "edit_med_id": "..." (UI state, in memory only)
 #       "name": "...",
 #       "phone": "...",
 #       "age": 0,
 #       "email": "...",
 #       "country": "EG"/"SA"/"DEFAULT",
 #       "paid": False,
-#       "medicines": [ { "id": "...", "اسم": "...", "الجرعة": "...", "الأوقات": ["08:30", ...] }, ... ],
-#       "temp": {...}
+#       "medicines": [ { "id": "...", "اسم": "...", "الجرعة": "...", "الأوقات": ["08:30", ...],
+#                        "slots": [510, ...] (parsed times, in memory only) }, ... ],
 #   }
 # }
 data = {}
+# where the user is in a dialog; lost on restart, which lands users on the menu
+EPHEMERAL_FIELDS = ("step", "edit_med_id", "temp")
+
+# in-progress "add medicine" drafts: uid -> {"اسم", "الجرعة", "needed", "candidate",
+# "الأوقات", "slots", "touched"}. Never persisted; only the finished med lands in data.
+# Abandoned drafts are dropped after SESSION_TTL of inactivity (prune_sessions).
+SESSIONS = {}
+SESSION_TTL = 24 * 3600
+
+# -----------------------
+# Per-user serialization
+# -----------------------
+# Handlers of the same user run one at a time (and a user's rows are encoded
+# for the writer while that lock is held); different users never wait on each other.
+_user_locks = weakref.WeakValueDictionary()
+_user_locks_guard = threading.Lock()
+
+def user_lock(uid: int) -> threading.Lock:
+    with _user_locks_guard:
+        lock = _user_locks.get(uid)
+        if lock is None:
+            lock = _user_locks[uid] = threading.Lock()
+        return lock
+
+def per_user(handler):
+    @wraps(handler)
+    def wrapper(update):
+        with user_lock(update.from_user.id):
+            return handler(update)
+    return wrapper
 
 # -----------------------
-# JSON save/load
+# SQLite save/load
 # -----------------------
+# Each user is one row in `users` (persisted fields as JSON) plus
+# one row per medicine. save_data(uid) encodes that user's rows (the caller
+# holds the user's lock) and queues them; a single writer thread writes them,
+# so a save costs O(user) instead of re-encoding every user. The database runs in WAL mode, where a commit is a
+# small append to the WAL file.
+save_queue = queue.Queue()
+WRITE_COALESCE_WINDOW = 0.05  # seconds
+_db_local = threading.local()
+
+def db() -> sqlite3.Connection:
+    """Connection for the current thread."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=268435456")
+        _db_local.conn = conn
+    return conn
+
+def init_db():
+    conn = db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                uid TEXT PRIMARY KEY,
+                profile TEXT NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS medicines (
+                uid TEXT NOT NULL,
+                id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT,
+                dose TEXT,
+                times TEXT NOT NULL,
+                PRIMARY KEY (uid, id)
+            )""")
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+        legacy = read_legacy_data()
+        if legacy:
+            with conn:
+                for uid, user in legacy.items():
+                    write_user(conn, *user_rows(uid, user))
+            print(f"Imported {len(legacy)} users from {LEGACY_DATA_FILE}")
+
+def read_legacy_data() -> dict:
+    legacy = {}
+    try:
+        if Path(LEGACY_DATA_FILE).exists():
+            with open(LEGACY_DATA_FILE, "rb") as f:
+                legacy = orjson.loads(f.read())
+    except Exception:
+        print("read_legacy_data failed:", traceback.format_exc())
+    return legacy
+
+def user_rows(uid: int, user: dict):
+    """Encode a user into its `users` row and `medicines` rows."""
+    uid = str(uid)  # the tables key users by text; data uses the int chat id
+    profile = {k: v for k, v in user.items() if k != "medicines" and k not in EPHEMERAL_FIELDS}
+    user_row = (uid, orjson.dumps(profile).decode())
+    med_rows = [(uid, m["id"], pos, m.get("اسم"), m.get("الجرعة"), orjson.dumps(m.get("الأوقات", [])).decode())
+                for pos, m in enumerate(user.get("medicines", []))]
+    return user_row, med_rows
+
+def write_user(conn: sqlite3.Connection, user_row: tuple, med_rows: list):
+    conn.execute(
+        "INSERT INTO users (uid, profile) VALUES (?, ?) "
+        "ON CONFLICT(uid) DO UPDATE SET profile = excluded.profile",
+        user_row)
+    conn.execute("DELETE FROM medicines WHERE uid = ?", (user_row[0],))
+    conn.executemany(
+        "INSERT INTO medicines (uid, id, position, name, dose, times) VALUES (?, ?, ?, ?, ?, ?)",
+        med_rows)
+
 def load_data():
     global data
+    flush_data()
     try:
-        if Path(DATA_FILE).exists():
-            with DATA_LOCK:
-                with open(DATA_FILE, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-        else:
-            data = {}
+        conn = db()
+        loaded = {}
+        for uid, profile in conn.execute("SELECT uid, profile FROM users"):
+            u = orjson.loads(profile)
+            u["medicines"] = []
+            loaded[int(uid)] = u
+        rows = conn.execute("SELECT uid, id, name, dose, times FROM medicines ORDER BY uid, position")
+        for uid, mid, name, dose, times in rows:
+            uid = int(uid)
+            if uid in loaded:
+                loaded[uid]["medicines"].append({"id": mid, "اسم": name, "الجرعة": dose, "الأوقات": orjson.loads(times)})
+        data = loaded
+        med_index.clear()
+        for uid in data:
+            index_meds(uid)
     except Exception:
         print("load_data failed:", traceback.format_exc())
         data = {}
 
-def save_data():
-    try:
-        with DATA_LOCK:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception:
-        print("save_data failed:", traceback.format_exc())
+_save_batch = threading.local()
+
+def queue_rows(uid: int):
+    # called with the user's lock held, so the writer never needs it
+    user = data.get(uid)
+    if user is not None:
+        save_queue.put((uid, user_rows(uid, user)))
+
+def save_data(uid: int):
+    pending = getattr(_save_batch, "uids", None)
+    if pending is not None:
+        pending.add(uid)  # inside an @autosave handler: queued once on exit
+        return
+    queue_rows(uid)
+
+def autosave(handler):
+    """Fuse every save_data() made while handling one update into one queued write per uid."""
+    @wraps(handler)
+    def wrapper(update):
+        if getattr(_save_batch, "uids", None) is not None:
+            return handler(update)
+        _save_batch.uids = set()
+        try:
+            return handler(update)
+        finally:
+            uids, _save_batch.uids = _save_batch.uids, None
+            for uid in uids:
+                queue_rows(uid)
+    return wrapper
+
+def flush_data():
+    """Block until every queued change has been written."""
+    save_queue.join()
+
+def data_writer():
+    # Saves arriving within WRITE_COALESCE_WINDOW are merged: each uid is
+    # written once per batch (its latest rows) and the whole batch is one
+    # transaction. Rows arrive already encoded, so no user lock is taken here.
+    conn = db()
+    while True:
+        batch = dict([save_queue.get()])
+        taken = 1
+        deadline = time.monotonic() + WRITE_COALESCE_WINDOW
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                uid, rows = save_queue.get(timeout=timeout)
+                batch[uid] = rows
+                taken += 1
+            except queue.Empty:
+                break
+        try:
+            with conn:
+                for user_row, med_rows in batch.values():
+                    write_user(conn, user_row, med_rows)
+        except Exception:
+            print("data_writer failed:", traceback.format_exc())
+        finally:
+            for _ in range(taken):
+                save_queue.task_done()
+
+init_db()
+threading.Thread(target=data_writer, name="data-writer", daemon=True).start()
+atexit.register(flush_data)
 
 # -----------------------
 # Scheduler helpers
 # -----------------------
-def sanitize_job_id(raw: str) -> str:
-    return "".join(c if c.isalnum() or c in "_-." else "_" for c in raw)
+# Reminders go out in bursts (everyone's 08:00 dose), so their sends are
+# paced under Telegram's ~30 messages/second bot limit and a 429 is retried
+# after the Retry-After the API asks for.
+TG_SEND_RATE = 30  # per second
+_tg_pace_lock = threading.Lock()
+_tg_next_send = 0.0
+
+def tg_send(method, *args, **kwargs):
+    global _tg_next_send
+    for attempt in range(3):
+        with _tg_pace_lock:
+            now = time.monotonic()
+            at = max(now, _tg_next_send)
+            _tg_next_send = at + 1 / TG_SEND_RATE
+        if at > now:
+            time.sleep(at - now)
+        try:
+            return method(*args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 429 or attempt == 2:
+                raise
+            time.sleep(e.result_json.get("parameters", {}).get("retry_after", 1))
+
+# SSML hash (see tts_key) -> (Telegram file_id of its first upload, upload time).
+# Any chat can resend by file_id, so each distinct reminder audio is uploaded
+# (and synthesized) once; entries expire with the cache files (prune_tts_cache).
+voice_file_ids = {}
+
+def is_bad_file_id(e: apihelper.ApiTelegramException) -> bool:
+    # e.g. "Bad Request: wrong file identifier/HTTP URL specified", "... invalid file_id"
+    desc = (e.description or "").lower()
+    return e.error_code == 400 and ("file identifier" in desc or "file_id" in desc)
 
-def send_reminder(user_id: int, med_id: str):
-    """Send text reminder and attempt Azure TTS voice if configured."""
+def send_voice_note(user_id: int, key: str, text: str, voice=None):
+    """Send the reminder audio: by file_id when Telegram already has it, else
+    upload the synthesized file (`voice`: a pending generate_azure_tts_audio)."""
+    entry = voice_file_ids.get(key)
+    if entry:
+        try:
+            tg_send(bot.send_voice, user_id, entry[0])
+            return
+        except apihelper.ApiTelegramException as e:
+            # only a bad id is the cache's fault; blocked/missing chats, exhausted
+            # 429s etc. say nothing about it and must not evict it for everyone
+            if not is_bad_file_id(e):
+                raise
+            voice_file_ids.pop(key, None)  # expired/unknown id: upload again
+    voice_path = voice.result() if voice else generate_azure_tts_audio(text)
+    if not voice_path:
+        return
+    path = Path(voice_path)
+    if not path.exists():
+        return
+    # (name, bytes), not a file object: a retried send uploads it again in full,
+    # and the part keeps its file name (requests would otherwise call it "voice")
+    msg = tg_send(bot.send_voice, user_id, (path.name, path.read_bytes()))
+    if msg and msg.voice:
+        voice_file_ids[key] = (msg.voice.file_id, time.time())
+
+def reminder_text(meds: list, hhmm: str) -> str:
+    if len(meds) == 1:
+        med = meds[0]
+        return f"⏰ تذكير بالدواء:\n💊 {med.get('اسم')}\n📝 الجرعة: {med.get('الجرعة')}\n🕒 الوقت: {hhmm}"
+    lines = "\n\n".join(f"💊 {med.get('اسم')}\n📝 الجرعة: {med.get('الجرعة')}" for med in meds)
+    return f"⏰ تذكير بالأدوية:\n{lines}\n\n🕒 الوقت: {hhmm}"
+
+def send_reminder(user_id: int, med_ids: set, hhmm: str):
+    """Send one text reminder for all of a user's meds due now, and attempt
+    Azure TTS voice if configured.
+
+    `hhmm` is the dose time the reminder is due at.
+    """
     try:
-        u = data.get(str(user_id))
+        u = data.get(user_id)
         if not u:
             return
-        med = next((m for m in u.get("medicines", []) if m.get("id") == med_id), None)
-        if not med:
+        # in the order of the user's list
+        meds = [m for m in u.get("medicines", []) if m["id"] in med_ids]
+        if not meds:
             return
-        now = datetime.now().strftime("%H:%M")
-        text = f"⏰ تذكير بالدواء:\n💊 {med.get('اسم')}\n📝 الجرعة: {med.get('الجرعة')}\n🕒 الوقت: {now}"
-        bot.send_message(user_id, text)
+        text = reminder_text(meds, hhmm)
+        tts = bool(CFG.azure_tts_key and CFG.azure_tts_region)
+        voice = None
+        if tts:
+            key = tts_key(text)
+            # audio Telegram already has is resent by file_id, no synthesis needed;
+            # otherwise synthesize while the text message is in flight
+            if key not in voice_file_ids:
+                voice = tts_pool.submit(generate_azure_tts_audio, text)
+        tg_send(bot.send_message, user_id, text)
 
         # Try Azure TTS -> send voice note
-        if AZURE_TTS_KEY and AZURE_TTS_REGION:
+        if tts:
             try:
-                voice_path = generate_azure_tts_audio(text, user_id, med_id)
-                if voice_path and Path(voice_path).exists():
-                    with open(voice_path, "rb") as vf:
-                        bot.send_voice(user_id, vf)
-                    # cleanup file
-                    try:
-                        os.remove(voice_path)
-                    except:
-                        pass
+                send_voice_note(user_id, key, text, voice)
             except Exception:
                 # log but don't crash
                 print("Azure TTS send failed:", traceback.format_exc())
     except Exception:
         print("send_reminder error:", traceback.format_exc())
 
-def schedule_med_jobs(user_id: str, med: dict):
-    # remove previous jobs for med
-    remove_med_jobs(user_id, med)
-    for idx, hhmm in enumerate(med.get("الأوقات", [])):
-        try:
-            hh, mm = map(int, hhmm.split(":"))
-        except Exception:
-            print(f"invalid time {hhmm} for med {med.get('اسم')}")
-            continue
-        raw = f"{user_id}__{med['id']}__{hhmm.replace(':','')}__{idx}"
-        jid = sanitize_job_id(raw)
-        job_func = partial(send_reminder, int(user_id), med['id'])
-        scheduler.add_job(func=job_func, trigger="cron", hour=hh, minute=mm, id=jid, replace_existing=True, misfire_grace_time=60)
-        print(f"Scheduled {jid} at {hhmm} for user {user_id}")
-
-def remove_med_jobs(user_id: str, med: dict):
-    for idx, hhmm in enumerate(med.get("الأوقات", [])):
-        raw = f"{user_id}__{med['id']}__{hhmm.replace(':','')}__{idx}"
-        jid = sanitize_job_id(raw)
-        try:
-            scheduler.remove_job(jid)
-        except Exception:
-            pass
+# \d (and int()) also match Arabic-Indic digits, so "٠٨:٣٠" is a valid time;
+# the range is checked on the ints rather than with ASCII-only classes
+HHMM_RE = re.compile(r"\s*(\d+)\s*:\s*(\d+)\s*")
+
+def parse_hhmm(hhmm: str):
+    """"HH:MM" -> minutes since midnight, or None if it isn't a valid time."""
+    m = HHMM_RE.fullmatch(hhmm)
+    if not m:
+        return None
+    hh, mm = int(m[1]), int(m[2])
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        return None
+    return hh * 60 + mm
+
+def med_slots(med: dict) -> list:
+    """Parsed "الأوقات" of a med (minutes since midnight, None if invalid).
+
+    Filled in when the times are entered; meds loaded from storage get it
+    on first use. Not persisted.
+    """
+    slots = med.get("slots")
+    if slots is None:
+        slots = med["slots"] = [parse_hhmm(t) for t in med.get("الأوقات", [])]
+    return slots
+
+# One scheduler job ("tick", every minute) fires the reminders due in that
+# minute from reminder_index: slot -> {(uid, med id, "HH:MM")}. The index is
+# derived from data (never persisted), updated per med by index_med_reminders /
+# unindex_med_reminders and rebuilt by reschedule_all(). No per-dose jobs exist.
+reminder_index = {}
+_reminders_lock = threading.Lock()
+reminder_pool = ThreadPoolExecutor(max_workers=10, thread_name_prefix="reminders")
+
+def index_med_reminders(user_id: int, med: dict):
+    # drop the med's previous entries first
+    unindex_med_reminders(user_id, med)
+    with _reminders_lock:
+        for hhmm, slot in zip(med.get("الأوقات", []), med_slots(med)):
+            if slot is None:
+                print(f"invalid time {hhmm} for med {med.get('اسم')}")
+                continue
+            reminder_index.setdefault(slot, set()).add((user_id, med["id"], hhmm))
+
+def unindex_med_reminders(user_id: int, med: dict):
+    # call before changing the med's times: entries are found by its current slots
+    with _reminders_lock:
+        for hhmm, slot in zip(med.get("الأوقات", []), med_slots(med)):
+            due = reminder_index.get(slot)
+            if due:
+                due.discard((user_id, med["id"], hhmm))
 
 def reschedule_all():
-    # remove our jobs
-    try:
-        for job in list(scheduler.get_jobs()):
-            if "__" in job.id:
-                try:
-                    scheduler.remove_job(job.id)
-                except Exception:
-                    pass
-    except Exception:
-        pass
-    # add from data
-    for uid, u in data.items():
+    index = {}
+    for uid, u in list(data.items()):  # handlers may add users meanwhile
         for med in u.get("medicines", []):
-            schedule_med_jobs(uid, med)
+            for hhmm, slot in zip(med.get("الأوقات", []), med_slots(med)):
+                if slot is None:
+                    print(f"invalid time {hhmm} for med {med.get('اسم')}")
+                    continue
+                index.setdefault(slot, set()).add((uid, med["id"], hhmm))
+    with _reminders_lock:
+        reminder_index.clear()
+        reminder_index.update(index)
+
+def tick():
+    now = time.localtime()
+    with _reminders_lock:
+        due = list(reminder_index.get(now.tm_hour * 60 + now.tm_min, ()))
+    # one message per user, however many of their meds are due this minute
+    by_user = {}
+    for uid, med_id, hhmm in due:
+        by_user.setdefault(uid, (set(), hhmm))[0].add(med_id)
+    for uid, (med_ids, hhmm) in by_user.items():
+        reminder_pool.submit(send_reminder, uid, med_ids, hhmm)
+
+scheduler.add_job(tick, "cron", second=0, id="tick", replace_existing=True, misfire_grace_time=60)
+
+def prune_sessions():
+    # a user who comes back later finds no draft and is sent to the menu (add_draft)
+    cutoff = time.monotonic() - SESSION_TTL
+    for uid, d in list(SESSIONS.items()):
+        if d["touched"] < cutoff:
+            SESSIONS.pop(uid, None)
+
+scheduler.add_job(prune_sessions, "interval", hours=1, id="prune_sessions", replace_existing=True)
 
 # -----------------------
 # Azure TTS (optional)
 # -----------------------
-def generate_azure_tts_audio(text: str, user_id: int, med_id: str) -> str:
+# STS tokens are valid for 10 minutes; reuse one for 9 instead of issuing a
+# new token per reminder. The session keeps the TLS connections warm too.
+azure_session = requests.Session()
+tts_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts")
+azure_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=Retry(total=2, backoff_factor=0.3)))
+_azure_token = {"value": None, "exp": 0.0}
+_azure_token_lock = threading.Lock()
+
+def get_azure_token():
+    with _azure_token_lock:
+        if time.time() < _azure_token["exp"] - 30:
+            return _azure_token["value"]
+        token_url = f"https://{CFG.azure_tts_region}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
+        headers = {"Ocp-Apim-Subscription-Key": CFG.azure_tts_key}
+        r = azure_session.post(token_url, headers=headers, timeout=10)
+        if r.status_code != 200:
+            print("Azure token failed", r.status_code, r.text)
+            return None
+        _azure_token["value"] = r.text
+        _azure_token["exp"] = time.time() + 540
+        return r.text
+
+SSML_TEMPLATE = ("<speak version='1.0' xml:lang='ar-EG'>"
+                 "<voice xml:lang='ar-EG' xml:gender='Female' name='ar-EG-SalmaNeural'>{}</voice>"
+                 "</speak>")
+
+def tts_ssml(text: str) -> bytes:
+    return SSML_TEMPLATE.format(escape_for_ssml(text)).encode("utf-8")
+
+def tts_key(text: str) -> str:
+    """sha256 of the reminder's SSML: names its tts_cache file and voice_file_ids entry."""
+    return hashlib.sha256(tts_ssml(text)).hexdigest()
+
+def generate_azure_tts_audio(text: str) -> str:
     """
-    Generate an mp3 via Azure TTS and return local filepath.
+    Generate an OGG/Opus voice note via Azure TTS and return local filepath.
     Requires AZURE_TTS_KEY and AZURE_TTS_REGION env vars.
+    The same text always maps to the same file in TTS_CACHE_DIR, so a
+    reminder repeating every day is synthesized once per TTS_CACHE_TTL.
     """
-    if not (AZURE_TTS_KEY and AZURE_TTS_REGION):
+    if not (CFG.azure_tts_key and CFG.azure_tts_region):
         return None
     try:
-        token_url = f"https://{AZURE_TTS_REGION}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
-        headers = {"Ocp-Apim-Subscription-Key": AZURE_TTS_KEY}
-        r = requests.post(token_url, headers=headers, timeout=10)
-        if r.status_code != 200:
-            print("Azure token failed", r.status_code, r.text)
+        ssml = tts_ssml(text)
+        path = TTS_CACHE_DIR / f"{hashlib.sha256(ssml).hexdigest()}.ogg"
+        try:
+            if time.time() - path.stat().st_mtime < TTS_CACHE_TTL:
+                return str(path)
+        except FileNotFoundError:
+            pass
+
+        access_token = get_azure_token()
+        if not access_token:
             return None
-        access_token = r.text
-
-        tts_url = f"https://{AZURE_TTS_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
-        ssml = f"""
-            <speak version='1.0' xml:lang='ar-EG'>
-                <voice xml:lang='ar-EG' xml:gender='Female' name='ar-EG-SalmaNeural'>
-                    {escape_for_ssml(text)}
-                </voice>
-            </speak>
-        """
+        tts_url = f"https://{CFG.azure_tts_region}.tts.speech.microsoft.com/cognitiveservices/v1"
         headers = {
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/ssml+xml",
-            "X-Microsoft-OutputFormat": "riff-16khz-16bit-mono-pcm",  # small wav
+            # OGG/Opus: Telegram only treats OGG/Opus (or MP3/M4A) as a voice note; a WAV
+            # comes back as a document, with no msg.voice to take the file_id from
+            "X-Microsoft-OutputFormat": "ogg-16khz-16bit-mono-opus",
             "User-Agent": "medibot"
         }
-        rr = requests.post(tts_url, headers=headers, data=ssml.encode("utf-8"), timeout=30)
-        if rr.status_code not in (200,201):
-            print("Azure TTS failed", rr.status_code, rr.text[:200])
-            return None
-        # save wav to temp file
-        fname = f"/tmp/tts_{user_id}_{med_id}_{uuid.uuid4().hex}.wav"
-        with open(fname, "wb") as f:
-            f.write(rr.content)
-        return fname
+        with azure_session.post(tts_url, headers=headers, data=ssml, timeout=30, stream=True) as rr:
+            if rr.status_code not in (200,201):
+                print("Azure TTS failed", rr.status_code, rr.text[:200])
+                return None
+            # stream to a temp name and rename, so readers never see a partial file
+            TTS_CACHE_DIR.mkdir(exist_ok=True)
+            tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp, "wb") as f:
+                for chunk in rr.iter_content(chunk_size=8192):
+                    f.write(chunk)
+        os.replace(tmp, path)
+        return str(path)
     except Exception:
         print("Azure TTS exception:", traceback.format_exc())
         return None
@@ -234,464 +606,588 @@ def escape_for_ssml(s: str) -> str:
     # minimal escaping
     return s.replace("&", "&amp;").replace("<","&lt;").replace(">","&gt;")
 
+def prune_tts_cache():
+    cutoff = time.time() - TTS_CACHE_TTL
+    for key, (_, uploaded) in list(voice_file_ids.items()):
+        if uploaded < cutoff:
+            voice_file_ids.pop(key, None)
+    for p in TTS_CACHE_DIR.glob("*"):
+        try:
+            if p.stat().st_mtime < cutoff:
+                p.unlink()
+        except OSError:
+            pass
+
+scheduler.add_job(prune_tts_cache, "interval", hours=24, id="prune_tts_cache", replace_existing=True)
+
 # -----------------------
 # Keyboards & UI
 # -----------------------
-def main_control_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("أدويتي", "💳 الباقات")
-    kb.row("🔙 الرجوع إلى القائمة السابقة")
-    return kb
-
-def mymeds_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("📋 عرض الأدوية", "➕ إضافة دواء")
-    kb.row("✏️ تعديل دواء", "🗑️ حذف دواء")
-    kb.row("🔙 رجوع")
-    return kb
-
-def times_count_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row("1", "2", "3", "4")
-    return kb
-
-def period_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row("صباحًا", "مساءً")
-    return kb
+# Keyboards are handed to send_message already serialized: telebot only calls
+# to_json() on markup objects and passes a JSON string through unchanged, so
+# building the string once skips a json.dumps per message.
+def reply_keyboard(*rows, one_time=False) -> str:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=one_time)
+    for row in rows:
+        kb.row(*row)
+    return kb.to_json()
 
-def payment_buttons_for_country(country_code: str):
+KB_REMOVE = types.ReplyKeyboardRemove().to_json()
+
+# Button labels, defined (and interned) once: the keyboards and the dispatch
+# tables share the same objects, so the two can't drift apart.
+BTN_MYMEDS = sys.intern("أدويتي")
+BTN_PACKAGES = sys.intern("💳 الباقات")
+BTN_BACK_MAIN = sys.intern("🔙 الرجوع إلى القائمة السابقة")
+BTN_BACK = sys.intern("🔙 رجوع")
+BTN_SHOW_MEDS = sys.intern("📋 عرض الأدوية")
+BTN_ADD_MED = sys.intern("➕ إضافة دواء")
+BTN_EDIT_MED = sys.intern("✏️ تعديل دواء")
+BTN_DELETE_MED = sys.intern("🗑️ حذف دواء")
+BTN_BACK_PLAIN = sys.intern("رجوع")
+
+# Static keyboards are built (and serialized) once at import and shared by every message.
+MAIN_CONTROL_KB = reply_keyboard((BTN_MYMEDS, BTN_PACKAGES), (BTN_BACK_MAIN,))
+MYMEDS_KB = reply_keyboard((BTN_SHOW_MEDS, BTN_ADD_MED), (BTN_EDIT_MED, BTN_DELETE_MED), (BTN_BACK,))
+TIMES_COUNT_KB = reply_keyboard(("1", "2", "3", "4"), one_time=True)
+PERIOD_KB = reply_keyboard(("صباحًا", "مساءً"), one_time=True)
+EDIT_FIELD_KB = reply_keyboard(("الاسم", "الجرعة"), ("الأوقات", BTN_BACK))
+
+@lru_cache(maxsize=1024)
+def meds_choice_keyboard(names: tuple):
+    """One button per medicine name (edit/delete pickers), cached per name list."""
+    return reply_keyboard(*((name,) for name in names), (BTN_BACK,))
+
+def payment_keyboard(plans) -> str:
     ik = types.InlineKeyboardMarkup()
-    if country_code == "EG":
-        ik.add(types.InlineKeyboardButton("خطة فردية - 97 جنيه", url="https://secure-egypt.paytabs.com/payment/link/140410/5615069"))
-        ik.add(types.InlineKeyboardButton("خطة عائلية - 190 جنيه", url="https://secure-egypt.paytabs.com/payment/link/140410/5594819"))
-    elif country_code == "SA":
-        ik.add(types.InlineKeyboardButton("خطة فردية - 59 SAR", url="https://secure-egypt.paytabs.com/payment/link/140410/5763844"))
-        ik.add(types.InlineKeyboardButton("خطة عائلية - 89 SAR", url="https://secure-egypt.paytabs.com/payment/link/140410/5763828"))
-    else:
-        ik.add(types.InlineKeyboardButton("Individual Plan - 9 USD", url="https://example.com"))
-        ik.add(types.InlineKeyboardButton("Family Plan - 15 USD", url="https://example.com"))
+    for label, url in plans:
+        ik.add(types.InlineKeyboardButton(label, url=url))
     # add confirm button (to click after paying)
     ik.add(types.InlineKeyboardButton("✅ لقد دفعت — تحقق", callback_data="paid_confirm"))
-    return ik
+    return ik.to_json()
+
+PAYMENT_KBS = {
+    "EG": payment_keyboard((
+        ("خطة فردية - 97 جنيه", "https://secure-egypt.paytabs.com/payment/link/140410/5615069"),
+        ("خطة عائلية - 190 جنيه", "https://secure-egypt.paytabs.com/payment/link/140410/5594819"))),
+    "SA": payment_keyboard((
+        ("خطة فردية - 59 SAR", "https://secure-egypt.paytabs.com/payment/link/140410/5763844"),
+        ("خطة عائلية - 89 SAR", "https://secure-egypt.paytabs.com/payment/link/140410/5763828"))),
+    "DEFAULT": payment_keyboard((
+        ("Individual Plan - 9 USD", "https://example.com"),
+        ("Family Plan - 15 USD", "https://example.com"))),
+}
+
+def payment_buttons_for_country(country_code: str):
+    return PAYMENT_KBS.get(country_code, PAYMENT_KBS["DEFAULT"])
 
 # -----------------------
 # Helpers
 # -----------------------
-def ensure_user(uid: str):
+def ensure_user(uid: int):
     if uid not in data:
         data[uid] = {"step": None, "medicines": [], "paid": False}
-        save_data()
+        save_data(uid)
+
+# Medicine lookups: uid -> ({id: med}, {name: med}). Derived from data (never
+# persisted) and rebuilt by index_meds() whenever a user's list or a name
+# changes; edits to dose/times mutate the indexed dict in place.
+med_index = {}
+
+def index_meds(uid: int):
+    meds = data.get(uid, {}).get("medicines", [])
+    by_name = {}
+    for m in meds:
+        by_name.setdefault(m["اسم"], m)  # first match wins, as with the old scan
+    med_index[uid] = ({m["id"]: m for m in meds}, by_name)
+
+def find_med(uid: int, med_id: str):
+    index = med_index.get(uid)
+    return index[0].get(med_id) if index else None
+
+def find_med_by_name(uid: int, name: str):
+    index = med_index.get(uid)
+    return index[1].get(name) if index else None
+
+# E.164: "+" then 7..15 digits (country code included)
+PHONE_RE = re.compile(r"\+\d{7,15}")
+# \d also matches Arabic-Indic digits, which int() accepts
+AGE_RE = re.compile(r"\d{1,3}")
+
+# country keyboard label -> country code
+COUNTRY_BY_LABEL = {
+    "مصر 🇪🇬": "EG",
+    "السعودية 🇸🇦": "SA",
+    "أخرى 🌍": "DEFAULT",
+}
+COUNTRY_KB = reply_keyboard(tuple(COUNTRY_BY_LABEL), one_time=True)
+
+def detect_country(text: str) -> str:
+    code = COUNTRY_BY_LABEL.get(text)
+    if code:
+        return code
+    # typed answer instead of a button press
+    if "مصر" in text:
+        return "EG"
+    if "سعودي" in text:
+        return "SA"
+    return "DEFAULT"
 
 # -----------------------
 # Bot handlers (sequential state machine)
 # -----------------------
 @bot.message_handler(commands=["start"])
+@per_user
+@autosave
 def cmd_start(m):
-    uid = str(m.from_user.id)
+    uid = m.from_user.id
     ensure_user(uid)
     data[uid]["step"] = "get_name"
-    save_data()
     bot.send_message(uid, "مرحبًا 👋\nأدخل اسمك الكامل:")
 
 @bot.callback_query_handler(func=lambda call: True)
+@per_user
+@autosave
 def callback_handler(call):
-    uid = str(call.from_user.id)
+    uid = call.from_user.id
     ensure_user(uid)
     # handle payment confirm
     if call.data == "paid_confirm":
         data[uid]["paid"] = True
-        save_data()
+        save_data(uid)
         bot.answer_callback_query(call.id, "✅ تم تأكيد الدفع (يتم التحقق لاحقًا).")
-        bot.send_message(uid, "شكرًا! تم التحقق مؤقتًا من الدفع. الوصول إلى لوحة التحكم مفعل الآن.", reply_markup=main_control_keyboard())
+        bot.send_message(uid, "شكرًا! تم التحقق مؤقتًا من الدفع. الوصول إلى لوحة التحكم مفعل الآن.", reply_markup=MAIN_CONTROL_KB)
         return
 
     bot.answer_callback_query(call.id, "تم الضغط: " + str(call.data))
 
 @bot.message_handler(func=lambda m: True)
+@per_user
+@autosave
 def state_machine(m):
-    uid = str(m.from_user.id)
+    uid = m.from_user.id
     text = (m.text or "").strip()
     ensure_user(uid)
     u = data[uid]
-    step = u.get("step")
-
-    # If user uses keyboard main control quick button "أدويتي" or "💳 الباقات"
-    if text == "أدويتي":
-        # require payment
-        if not u.get("paid"):
-            bot.send_message(uid, "يجب إتمام الدفع أولاً للوصول إلى أدويتي. اختر باقة:", reply_markup=payment_buttons_for_country(u.get("country","DEFAULT")))
-            u["step"] = "awaiting_payment"
-            save_data()
-            return
-        u["step"] = "in_mymeds"
-        save_data()
-        bot.send_message(uid, "لوحة أدوِيتي:", reply_markup=mymeds_keyboard())
+    # global buttons win over the current step
+    handler = BUTTON_HANDLERS.get(text) or STEP_HANDLERS.get(u.get("step"), handle_unknown)
+    handler(uid, u, text)
+
+# -----------------------
+# Step handlers
+# -----------------------
+# state_machine dispatches on the pressed button through BUTTON_HANDLERS, else
+# on u["step"] through STEP_HANDLERS; every handler takes (uid, u, text).
+
+# Registration flow steps
+# (fields stay in memory until "choose_country", which persists them once)
+def handle_get_name(uid: int, u: dict, text: str):
+    u["name"] = text
+    u["step"] = "get_phone"
+    bot.send_message(uid, "حسنًا. الآن أرسل رقم هاتفك مع رمز الدولة (مثال: +20XXXXXXXXX):", reply_markup=KB_REMOVE)
+
+def handle_get_phone(uid: int, u: dict, text: str):
+    phone = text.replace(" ", "").replace("-", "")
+    if not PHONE_RE.fullmatch(phone):
+        bot.send_message(uid, "الرجاء إدخال رقم هاتف صحيح مع رمز الدولة مثل: +201XXXXXXXXX")
         return
+    u["phone"] = phone
+    u["step"] = "get_age"
+    bot.send_message(uid, "أدخل عمرك (أرقام فقط):")
 
-    if text == "💳 الباقات":
-        bot.send_message(uid, "اختر باقتك:", reply_markup=types.ReplyKeyboardRemove())
-        bot.send_message(uid, "روابط الدفع:", reply_markup=payment_buttons_for_country(u.get("country","DEFAULT")))
-        u["step"] = "awaiting_payment"
-        save_data()
+def handle_get_age(uid: int, u: dict, text: str):
+    if not AGE_RE.fullmatch(text) or not 0 < int(text) < 120:
+        bot.send_message(uid, "من فضلك أدخل رقم صحيح للسن.")
+        return
+    u["age"] = int(text)
+    u["step"] = "get_email"
+    bot.send_message(uid, "أدخل بريدك الإلكتروني:")
+
+def handle_get_email(uid: int, u: dict, text: str):
+    # minimal email check
+    if "@" not in text or "." not in text:
+        bot.send_message(uid, "من فضلك أدخل بريد إلكتروني صالح.")
         return
+    u["email"] = text
+    u["step"] = "choose_country"
+    bot.send_message(uid, "اختر دولتك:", reply_markup=COUNTRY_KB)
+
+def handle_choose_country(uid: int, u: dict, text: str):
+    u["country"] = detect_country(text)
+    u["step"] = "post_signup"
+    save_data(uid)
+    # send payment options immediately (per your flow)
+    bot.send_message(uid, f"شكرًا {u.get('name')}! اختر باقتك للدفع:", reply_markup=payment_buttons_for_country(u.get("country")))
 
-    if text == "🔙 الرجوع إلى القائمة السابقة" or text == "🔙 رجوع" or text == "رجوع":
-        # return to main control
+# awaiting payment (user clicked link externally)
+def handle_awaiting_payment(uid: int, u: dict, text: str):
+    # allow user to click confirmation button via inline keyboard; also accept text "تم الدفع"
+    if text in {"تم الدفع", "دفعت", "paid", "تم"}:
+        u["paid"] = True
         u["step"] = "menu"
-        save_data()
-        bot.send_message(uid, "تم الرجوع للقائمة الرئيسية.", reply_markup=main_control_keyboard())
+        save_data(uid)
+        bot.send_message(uid, "✅ تم وضع علامة الدفع مؤقتًا. إذا كنت تريد، اضغط تأكيد الدفع في زر الرابط.\nتم تفعيل لوحة التحكم:", reply_markup=MAIN_CONTROL_KB)
+    else:
+        bot.send_message(uid, "اضغط على رابط الدفع أو اضغط زر '✅ لقد دفعت — تحقق' بعد إتمام الدفع.")
+
+# Post signup default menu (after payment or if not required)
+def handle_menu(uid: int, u: dict, text: str):
+    # show main control keyboard
+    u["step"] = "menu"
+    bot.send_message(uid, f"مرحبًا {u.get('name','')} — هذه لوحة التحكم الرئيسية:", reply_markup=MAIN_CONTROL_KB)
+
+# ----------------------------
+# My meds submenu flows
+# ----------------------------
+def handle_in_mymeds(uid: int, u: dict, text: str):
+    action = MYMEDS_ACTIONS.get(text)
+    if action:
+        action(uid, u, text)
         return
+    u["step"] = "in_mymeds"
+    bot.send_message(uid, "لوحة أدوِيتي:", reply_markup=MYMEDS_KB)
 
-    # Registration flow steps
-    if step == "get_name":
-        u["name"] = text
-        u["step"] = "get_phone"
-        save_data()
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        kb.row("أرسل رقم مع كود الدولة (مثال +20XXXXXXXXX)")
-        bot.send_message(uid, "حسنًا. الآن أرسل رقم هاتفك مع رمز الدولة (مثال: +20XXXXXXXXX):", reply_markup=types.ReplyKeyboardRemove())
+# View meds
+def show_meds(uid: int, u: dict, text: str):
+    meds = u.get("medicines", [])
+    if not meds:
+        bot.send_message(uid, "لا توجد أدوية مسجلة.", reply_markup=MYMEDS_KB)
+        u["step"] = "in_mymeds"
         return
+    lines = []
+    for i,m in enumerate(meds, start=1):
+        lines.append(f"{i}. {m.get('اسم')} — {m.get('الجرعة')}\nالأوقات: {', '.join(m.get('الأوقات', []))}")
+    bot.send_message(uid, "📋 قائمة أدوِيتي:\n\n" + "\n\n".join(lines), reply_markup=MYMEDS_KB)
+    u["step"] = "in_mymeds"
 
-    if step == "get_phone":
-        # minimal validation
-        if not text.startswith("+") or len(text) < 7:
-            bot.send_message(uid, "الرجاء إدخال رقم هاتف صحيح مع رمز الدولة مثل: +201XXXXXXXXX")
-            return
-        u["phone"] = text
-        u["step"] = "get_age"
-        save_data()
-        bot.send_message(uid, "أدخل عمرك (أرقام فقط):")
+# user clicked "➕ إضافة دواء" from keyboard
+def start_add_med(uid: int, u: dict, text: str):
+    u["step"] = "med_name"
+    bot.send_message(uid, "أدخل اسم الدواء:")
+
+# Edit med flow start
+def start_edit_med(uid: int, u: dict, text: str):
+    meds = u.get("medicines", [])
+    if not meds:
+        bot.send_message(uid, "لا توجد أدوية للتعديل.", reply_markup=MYMEDS_KB)
         return
+    u["step"] = "choose_edit"
+    bot.send_message(uid, "اختر الدواء الذي تريد تعديله:", reply_markup=meds_choice_keyboard(tuple(m["اسم"] for m in meds)))
 
-    if step == "get_age":
-        if not text.isdigit():
-            bot.send_message(uid, "من فضلك أدخل رقم صحيح للسن.")
-            return
-        u["age"] = int(text)
-        u["step"] = "get_email"
-        save_data()
-        bot.send_message(uid, "أدخل بريدك الإلكتروني:")
+# Delete flow
+def start_delete_med(uid: int, u: dict, text: str):
+    meds = u.get("medicines", [])
+    if not meds:
+        bot.send_message(uid, "لا توجد أدوية للحذف.", reply_markup=MYMEDS_KB)
         return
+    u["step"] = "choose_delete"
+    bot.send_message(uid, "اختر الدواء للحذف:", reply_markup=meds_choice_keyboard(tuple(m["اسم"] for m in meds)))
 
-    if step == "get_email":
-        # minimal email check
-        if "@" not in text or "." not in text:
-            bot.send_message(uid, "من فضلك أدخل بريد إلكتروني صالح.")
-            return
-        u["email"] = text
-        u["step"] = "choose_country"
-        save_data()
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        kb.row("مصر 🇪🇬", "السعودية 🇸🇦", "أخرى 🌍")
-        bot.send_message(uid, "اختر دولتك:", reply_markup=kb)
-        return
-
-    if step == "choose_country":
-        if "مصر" in text:
-            u["country"] = "EG"
-        elif "سعودي" in text or "السعودية" in text:
-            u["country"] = "SA"
-        else:
-            u["country"] = "DEFAULT"
-        u["step"] = "post_signup"
-        save_data()
-        # send payment options immediately (per your flow)
-        bot.send_message(uid, f"شكرًا {u.get('name')}! اختر باقتك للدفع:", reply_markup=payment_buttons_for_country(u.get("country")))
-        return
-
-    # awaiting payment (user clicked link externally)
-    if step == "awaiting_payment":
-        # allow user to click confirmation button via inline keyboard; also accept text "تم الدفع"
-        if text in {"تم الدفع", "دفعت", "paid", "تم"}:
-            u["paid"] = True
-            u["step"] = "menu"
-            save_data()
-            bot.send_message(uid, "✅ تم وضع علامة الدفع مؤقتًا. إذا كنت تريد، اضغط تأكيد الدفع في زر الرابط.\nتم تفعيل لوحة التحكم:", reply_markup=main_control_keyboard())
-            return
-        else:
-            bot.send_message(uid, "اضغط على رابط الدفع أو اضغط زر '✅ لقد دفعت — تحقق' بعد إتمام الدفع.")
-            return
+# Add med flow
+def add_draft(uid: int, u: dict):
+    """Return the user's add-med draft, or reset to the menu if it was lost (restart)."""
+    draft = SESSIONS.get(uid)
+    if draft is None:
+        u["step"] = "menu"
+        bot.send_message(uid, "حدث خطأ، الرجاء البدء من جديد.", reply_markup=MAIN_CONTROL_KB)
+    else:
+        draft["touched"] = time.monotonic()
+    return draft
+
+def handle_med_name(uid: int, u: dict, text: str):
+    # used when user pressed ➕ إضافة دواء
+    SESSIONS[uid] = {"اسم": text, "touched": time.monotonic()}
+    u["step"] = "med_dose"
+    bot.send_message(uid, "أدخل الجرعة (مثال: حبة واحدة):")
+
+def handle_med_dose(uid: int, u: dict, text: str):
+    draft = add_draft(uid, u)
+    if draft is None:
+        return
+    draft["الجرعة"] = text
+    u["step"] = "med_times_count"
+    bot.send_message(uid, "كم مرة يوميًا؟ اختر 1..4", reply_markup=TIMES_COUNT_KB)
+
+def handle_med_times_count(uid: int, u: dict, text: str):
+    if text not in {"1","2","3","4"}:
+        bot.send_message(uid, "اختر رقم من 1 إلى 4 باستخدام الأزرار.")
+        return
+    draft = add_draft(uid, u)
+    if draft is None:
+        return
+    draft["needed"] = int(text)
+    draft["الأوقات"] = []
+    draft["slots"] = []
+    u["step"] = "med_time_input"
+    bot.send_message(uid, f"أدخل وقت الجرعة 1 بصيغة HH:MM (مثال: 08:30):", reply_markup=KB_REMOVE)
+
+def handle_med_time_input(uid: int, u: dict, text: str):
+    # validate
+    slot = parse_hhmm(text)
+    if slot is None:
+        bot.send_message(uid, "صيغة خاطئة. استخدم HH:MM مثل 08:30")
+        return
+    draft = add_draft(uid, u)
+    if draft is None:
+        return
+    # ask period
+    draft["candidate"] = slot
+    u["step"] = "med_time_period"
+    bot.send_message(uid, "اختر الفترة لهذا الوقت:", reply_markup=PERIOD_KB)
 
-    # Post signup default menu (after payment or if not required)
-    if step in (None, "post_signup", "menu"):
-        # show main control keyboard
+def handle_med_time_period(uid: int, u: dict, text: str):
+    draft = add_draft(uid, u)
+    if draft is None:
+        return
+    candidate = draft.get("candidate")
+    if candidate is None:
         u["step"] = "menu"
-        save_data()
-        bot.send_message(uid, f"مرحبًا {u.get('name','')} — هذه لوحة التحكم الرئيسية:", reply_markup=main_control_keyboard())
+        bot.send_message(uid, "حدث خطأ، الرجاء البدء من جديد.", reply_markup=MAIN_CONTROL_KB)
         return
+    hh, mm = divmod(candidate, 60)
+    if text == "صباحًا":
+        if hh == 12:
+            hh = 0
+    elif text == "مساءً":
+        if hh < 12:
+            hh += 12
+    else:
+        bot.send_message(uid, "اختيار غير صالح. اختر صباحًا أو مساءً.")
+        return
+    hhmm24 = f"{hh:02d}:{mm:02d}"
+    draft["الأوقات"].append(hhmm24)
+    draft["slots"].append(hh * 60 + mm)
+    draft.pop("candidate")
+    collected = len(draft["الأوقات"])
+    if collected < draft["needed"]:
+        u["step"] = "med_time_input"
+        bot.send_message(uid, f"✅ حفظ الوقت {hhmm24}. الآن أرسل الوقت رقم {collected+1}:")
+        return
+    # finalize med: built once from the draft, then a single save
+    SESSIONS.pop(uid, None)
+    med = {
+        "id": secrets.token_hex(8),
+        "اسم": draft["اسم"],
+        "الجرعة": draft["الجرعة"],
+        "الأوقات": draft["الأوقات"],
+        "slots": draft["slots"],
+    }
+    u.setdefault("medicines", []).append(med)
+    index_meds(uid)
+    u["step"] = "menu"
+    save_data(uid)
+    index_med_reminders(uid, med)
+    bot.send_message(uid, "✅ تم إضافة الدواء وتم جدولة التذكيرات.", reply_markup=MAIN_CONTROL_KB)
 
-    # ----------------------------
-    # My meds submenu flows
-    # ----------------------------
-    if step == "in_mymeds":
-        # handled above via "أدويتي" button; keep state here
+def handle_choose_edit(uid: int, u: dict, text: str):
+    if text == BTN_BACK:
         u["step"] = "in_mymeds"
-        save_data()
-        bot.send_message(uid, "لوحة أدوِيتي:", reply_markup=mymeds_keyboard())
+        bot.send_message(uid, "تم الرجوع.", reply_markup=MYMEDS_KB)
+        return
+    chosen = find_med_by_name(uid, text)
+    if not chosen:
+        bot.send_message(uid, "اختيار غير موجود.")
         return
+    u["edit_med_id"] = chosen["id"]
+    u["step"] = "edit_field"
+    bot.send_message(uid, "ماذا تريد تعديل؟", reply_markup=EDIT_FIELD_KB)
 
-    # Add med flow
-    if step == "med_name":
-        # used when user pressed ➕ إضافة دواء
-        u["temp"] = {"اسم": text}
-        u["step"] = "med_dose"
-        save_data()
-        bot.send_message(uid, "أدخل الجرعة (مثال: حبة واحدة):")
+def handle_edit_field(uid: int, u: dict, text: str):
+    med = find_med(uid, u.get("edit_med_id"))
+    if not med:
+        bot.send_message(uid, "خطأ داخلي: الدواء غير موجود.")
+        u["step"] = "menu"
+        return
+    if text == "الاسم":
+        u["step"] = "edit_name"
+        bot.send_message(uid, "أدخل الاسم الجديد:")
+        return
+    if text == "الجرعة":
+        u["step"] = "edit_dose"
+        bot.send_message(uid, "أدخل الجرعة الجديدة:")
+        return
+    if text == "الأوقات":
+        u["step"] = "edit_times"
+        bot.send_message(uid, "أدخل الأوقات الجديدة مفصولة بفواصل مثل:\n08:00,14:30")
+        return
+    if text == BTN_BACK:
+        u["step"] = "in_mymeds"
+        bot.send_message(uid, "تم الرجوع.", reply_markup=MYMEDS_KB)
         return
+    handle_unknown(uid, u, text)
 
-    if step == "med_dose":
-        u["temp"]["الجرعة"] = text
-        u["step"] = "med_times_count"
-        save_data()
-        bot.send_message(uid, "كم مرة يوميًا؟ اختر 1..4", reply_markup=times_count_keyboard())
+def handle_edit_name(uid: int, u: dict, text: str):
+    med = find_med(uid, u.get("edit_med_id"))
+    if not med:
+        handle_unknown(uid, u, text)
         return
+    med["اسم"] = text
+    index_meds(uid)
+    save_data(uid)
+    bot.send_message(uid, "تم تعديل الاسم.", reply_markup=MYMEDS_KB)
+    u["step"] = "in_mymeds"
 
-    if step == "med_times_count":
-        if text not in {"1","2","3","4"}:
-            bot.send_message(uid, "اختر رقم من 1 إلى 4 باستخدام الأزرار.")
-            return
-        cnt = int(text)
-        u["temp"]["times_needed"] = cnt
-        u["temp"]["times_collected"] = 0
-        u["temp"]["الأوقات"] = []
-        u["step"] = "med_time_input"
-        save_data()
-        bot.send_message(uid, f"أدخل وقت الجرعة 1 بصيغة HH:MM (مثال: 08:30):", reply_markup=types.ReplyKeyboardRemove())
+def handle_edit_dose(uid: int, u: dict, text: str):
+    med = find_med(uid, u.get("edit_med_id"))
+    if not med:
+        handle_unknown(uid, u, text)
         return
+    med["الجرعة"] = text
+    save_data(uid)
+    bot.send_message(uid, "تم تعديل الجرعة.", reply_markup=MYMEDS_KB)
+    u["step"] = "in_mymeds"
 
-    if step == "med_time_input":
-        # validate
-        try:
-            hh, mm = map(int, text.split(":"))
-            if not (0 <= hh < 24 and 0 <= mm < 60):
-                raise ValueError()
-        except Exception:
-            bot.send_message(uid, "صيغة خاطئة. استخدم HH:MM مثل 08:30")
-            return
-        # ask period
-        u["temp"]["current_time_candidate"] = text
-        u["step"] = "med_time_period"
-        save_data()
-        bot.send_message(uid, "اختر الفترة لهذا الوقت:", reply_markup=period_keyboard())
-        return
-
-    if step == "med_time_period":
-        candidate = u["temp"].get("current_time_candidate")
-        if not candidate:
-            u["step"] = "menu"
-            save_data()
-            bot.send_message(uid, "حدث خطأ، الرجاء البدء من جديد.", reply_markup=main_control_keyboard())
-            return
-        try:
-            hh, mm = map(int, candidate.split(":"))
-        except:
-            bot.send_message(uid, "خطأ في الوقت.")
-            u["step"] = "menu"
-            return
-        if text == "صباحًا":
-            if hh == 12:
-                hh = 0
-        elif text == "مساءً":
-            if hh < 12:
-                hh += 12
-        else:
-            bot.send_message(uid, "اختيار غير صالح. اختر صباحًا أو مساءً.")
-            return
-        hhmm24 = f"{hh:02d}:{mm:02d}"
-        u["temp"].setdefault("الأوقات", []).append(hhmm24)
-        u["temp"]["times_collected"] += 1
-        needed = u["temp"]["times_needed"]
-        collected = u["temp"]["times_collected"]
-        u["temp"].pop("current_time_candidate", None)
-        if collected < needed:
-            u["step"] = "med_time_input"
-            save_data()
-            bot.send_message(uid, f"✅ حفظ الوقت {hhmm24}. الآن أرسل الوقت رقم {collected+1}:")
-            return
-        else:
-            # finalize med
-            med = {
-                "id": str(int(time.time()*1000)),
-                "اسم": u["temp"]["اسم"],
-                "الجرعة": u["temp"]["الجرعة"],
-                "الأوقات": u["temp"]["الأوقات"]
-            }
-            u.setdefault("medicines", []).append(med)
-            save_data()
-            schedule_med_jobs(uid, med)
-            u.pop("temp", None)
-            u["step"] = "menu"
-            save_data()
-            bot.send_message(uid, "✅ تم إضافة الدواء وتم جدولة التذكيرات.", reply_markup=main_control_keyboard())
-            return
+def handle_edit_times(uid: int, u: dict, text: str):
+    med = find_med(uid, u.get("edit_med_id"))
+    if not med:
+        handle_unknown(uid, u, text)
+        return
+    slots = [parse_hhmm(t.strip()) for t in text.split(",") if t.strip()]
+    # validate once here, so the scheduler never sees a malformed time
+    if not slots or None in slots:
+        bot.send_message(uid, "صيغة خاطئة. استخدم HH:MM مفصولة بفواصل مثل:\n08:00,14:30")
+        return
+    unindex_med_reminders(uid, med)  # reminders are indexed by the old times
+    med["الأوقات"] = [f"{s // 60:02d}:{s % 60:02d}" for s in slots]
+    med["slots"] = slots
+    save_data(uid)
+    index_med_reminders(uid, med)
+    bot.send_message(uid, "تم تعديل الأوقات.", reply_markup=MYMEDS_KB)
+    u["step"] = "in_mymeds"
 
-    # View meds
-    if step == "view_meds" or text == "📋 عرض الأدوية":
-        meds = u.get("medicines", [])
-        if not meds:
-            bot.send_message(uid, "لا توجد أدوية مسجلة.", reply_markup=mymeds_keyboard())
-            u["step"] = "in_mymeds"
-            return
-        lines = []
-        for i,m in enumerate(meds, start=1):
-            lines.append(f"{i}. {m.get('اسم')} — {m.get('الجرعة')}\nالأوقات: {', '.join(m.get('الأوقات', []))}")
-        bot.send_message(uid, "📋 قائمة أدوِيتي:\n\n" + "\n\n".join(lines), reply_markup=mymeds_keyboard())
+def handle_choose_delete(uid: int, u: dict, text: str):
+    if text == BTN_BACK:
         u["step"] = "in_mymeds"
-        save_data()
+        bot.send_message(uid, "تم الرجوع.", reply_markup=MYMEDS_KB)
         return
+    chosen = find_med_by_name(uid, text)
+    if not chosen:
+        bot.send_message(uid, "الدواء غير موجود.")
+        return
+    unindex_med_reminders(uid, chosen)
+    u["medicines"].remove(chosen)
+    index_meds(uid)
+    save_data(uid)
+    bot.send_message(uid, "تم حذف الدواء.", reply_markup=MYMEDS_KB)
+    u["step"] = "in_mymeds"
 
-    # user clicked "➕ إضافة دواء" from keyboard
-    if text == "➕ إضافة دواء":
-        u["step"] = "med_name"
-        save_data()
-        bot.send_message(uid, "أدخل اسم الدواء:")
+# Buttons that work from any step
+def open_mymeds(uid: int, u: dict, text: str):
+    # require payment
+    if not u.get("paid"):
+        bot.send_message(uid, "يجب إتمام الدفع أولاً للوصول إلى أدويتي. اختر باقة:", reply_markup=payment_buttons_for_country(u.get("country","DEFAULT")))
+        u["step"] = "awaiting_payment"
         return
+    u["step"] = "in_mymeds"
+    bot.send_message(uid, "لوحة أدوِيتي:", reply_markup=MYMEDS_KB)
 
-    # Edit med flow start
-    if text == "✏️ تعديل دواء":
-        meds = u.get("medicines", [])
-        if not meds:
-            bot.send_message(uid, "لا توجد أدوية للتعديل.", reply_markup=mymeds_keyboard())
-            return
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        for m in meds:
-            kb.row(m["اسم"])
-        kb.row("🔙 رجوع")
-        u["step"] = "choose_edit"
-        save_data()
-        bot.send_message(uid, "اختر الدواء الذي تريد تعديله:", reply_markup=kb)
-        return
-
-    if step == "choose_edit":
-        if text == "🔙 رجوع":
-            u["step"] = "in_mymeds"
-            save_data()
-            bot.send_message(uid, "تم الرجوع.", reply_markup=mymeds_keyboard())
-            return
-        meds = u.get("medicines", [])
-        chosen = next((m for m in meds if m["اسم"] == text), None)
-        if not chosen:
-            bot.send_message(uid, "اختيار غير موجود.")
-            return
-        u["edit_med_id"] = chosen["id"]
-        u["step"] = "edit_field"
-        save_data()
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.row("الاسم", "الجرعة")
-        kb.row("الأوقات", "🔙 رجوع")
-        bot.send_message(uid, "ماذا تريد تعديل؟", reply_markup=kb)
-        return
-
-    if step == "edit_field":
-        mid = u.get("edit_med_id")
-        meds = u.get("medicines", [])
-        med = next((m for m in meds if m["id"] == mid), None)
-        if not med:
-            bot.send_message(uid, "خطأ داخلي: الدواء غير موجود.")
-            u["step"] = "menu"
-            save_data()
-            return
-        if text == "الاسم":
-            u["step"] = "edit_name"
-            save_data()
-            bot.send_message(uid, "أدخل الاسم الجديد:")
-            return
-        if text == "الجرعة":
-            u["step"] = "edit_dose"
-            save_data()
-            bot.send_message(uid, "أدخل الجرعة الجديدة:")
-            return
-        if text == "الأوقات":
-            u["step"] = "edit_times"
-            save_data()
-            bot.send_message(uid, "أدخل الأوقات الجديدة مفصولة بفواصل مثل:\n08:00,14:30")
-            return
-        if text == "🔙 رجوع":
-            u["step"] = "in_mymeds"
-            save_data()
-            bot.send_message(uid, "تم الرجوع.", reply_markup=mymeds_keyboard())
-            return
+def show_packages(uid: int, u: dict, text: str):
+    bot.send_message(uid, "اختر باقتك:", reply_markup=KB_REMOVE)
+    bot.send_message(uid, "روابط الدفع:", reply_markup=payment_buttons_for_country(u.get("country","DEFAULT")))
+    u["step"] = "awaiting_payment"
 
-    if step == "edit_name":
-        mid = u.get("edit_med_id")
-        med = next((m for m in u.get("medicines", []) if m["id"] == mid), None)
-        if med:
-            med["اسم"] = text
-            save_data()
-            bot.send_message(uid, "تم تعديل الاسم.", reply_markup=mymeds_keyboard())
-            u["step"] = "in_mymeds"
-            return
+def go_back(uid: int, u: dict, text: str):
+    # return to main control
+    u["step"] = "menu"
+    bot.send_message(uid, "تم الرجوع للقائمة الرئيسية.", reply_markup=MAIN_CONTROL_KB)
 
-    if step == "edit_dose":
-        mid = u.get("edit_med_id")
-        med = next((m for m in u.get("medicines", []) if m["id"] == mid), None)
-        if med:
-            med["الجرعة"] = text
-            save_data()
-            bot.send_message(uid, "تم تعديل الجرعة.", reply_markup=mymeds_keyboard())
-            u["step"] = "in_mymeds"
-            return
+# Fallback: if nothing matched
+def handle_unknown(uid: int, u: dict, text: str):
+    bot.send_message(uid, "لم أفهم. استخدم الأزرار الموضحة أو اكتب /start للبدء.", reply_markup=MAIN_CONTROL_KB)
 
-    if step == "edit_times":
-        mid = u.get("edit_med_id")
-        med = next((m for m in u.get("medicines", []) if m["id"] == mid), None)
-        if med:
-            arr = [t.strip() for t in text.split(",") if t.strip()]
-            med["الأوقات"] = arr
-            save_data()
-            schedule_med_jobs(uid, med)
-            bot.send_message(uid, "تم تعديل الأوقات.", reply_markup=mymeds_keyboard())
-            u["step"] = "in_mymeds"
-            return
+# buttons of the "أدويتي" keyboard, handled while step == "in_mymeds"
+MYMEDS_ACTIONS = {
+    BTN_SHOW_MEDS: show_meds,
+    BTN_ADD_MED: start_add_med,
+    BTN_EDIT_MED: start_edit_med,
+    BTN_DELETE_MED: start_delete_med,
+}
 
-    # Delete flow
-    if text == "🗑️ حذف دواء":
-        meds = u.get("medicines", [])
-        if not meds:
-            bot.send_message(uid, "لا توجد أدوية للحذف.", reply_markup=mymeds_keyboard())
-            return
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        for m in meds:
-            kb.row(m["اسم"])
-        kb.row("🔙 رجوع")
-        u["step"] = "choose_delete"
-        save_data()
-        bot.send_message(uid, "اختر الدواء للحذف:", reply_markup=kb)
-        return
-
-    if step == "choose_delete":
-        if text == "🔙 رجوع":
-            u["step"] = "in_mymeds"
-            save_data()
-            bot.send_message(uid, "تم الرجوع.", reply_markup=mymeds_keyboard())
-            return
-        meds = u.get("medicines", [])
-        chosen = next((m for m in meds if m["اسم"] == text), None)
-        if not chosen:
-            bot.send_message(uid, "الدواء غير موجود.")
-            return
-        remove_med_jobs(uid, chosen)
-        u["medicines"].remove(chosen)
-        save_data()
-        bot.send_message(uid, "تم حذف الدواء.", reply_markup=mymeds_keyboard())
-        u["step"] = "in_mymeds"
-        return
+# main control buttons, handled whatever the current step is
+BUTTON_HANDLERS = {
+    BTN_MYMEDS: open_mymeds,
+    BTN_PACKAGES: show_packages,
+    BTN_BACK_MAIN: go_back,
+    BTN_BACK: go_back,
+    BTN_BACK_PLAIN: go_back,
+}
 
-    # Fallback: if nothing matched
-    bot.send_message(uid, "لم أفهم. استخدم الأزرار الموضحة أو اكتب /start للبدء.", reply_markup=main_control_keyboard())
+STEP_HANDLERS = {
+    "get_name": handle_get_name,
+    "get_phone": handle_get_phone,
+    "get_age": handle_get_age,
+    "get_email": handle_get_email,
+    "choose_country": handle_choose_country,
+    "awaiting_payment": handle_awaiting_payment,
+    None: handle_menu,
+    "post_signup": handle_menu,
+    "menu": handle_menu,
+    "in_mymeds": handle_in_mymeds,
+    "med_name": handle_med_name,
+    "med_dose": handle_med_dose,
+    "med_times_count": handle_med_times_count,
+    "med_time_input": handle_med_time_input,
+    "med_time_period": handle_med_time_period,
+    "choose_edit": handle_choose_edit,
+    "edit_field": handle_edit_field,
+    "edit_name": handle_edit_name,
+    "edit_dose": handle_edit_dose,
+    "edit_times": handle_edit_times,
+    "choose_delete": handle_choose_delete,
+}
+
+# -----------------------
+# Webhook update dispatch
+# -----------------------
+# One single-thread lane per worker: every update of a chat lands in the same
+# lane so it is handled in order, while different chats run concurrently.
+update_lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"updates{i}") for i in range(CFG.update_workers)]
+# The executors' queues are unbounded, so each lane takes at most its share of
+# UPDATE_QUEUE_SIZE updates (queued + running); past that the webhook answers
+# 503 and Telegram redelivers later instead of us buffering without limit.
+UPDATE_QUEUE_SIZE = 10_000
+lane_slots = [threading.BoundedSemaphore(max(1, UPDATE_QUEUE_SIZE // CFG.update_workers)) for _ in update_lanes]
+
+def update_chat_id(update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+def process_update(update, slots: threading.BoundedSemaphore):
+    try:
+        bot.process_new_updates([update])
+    except Exception:
+        print("update processing failed:", traceback.format_exc())
+    finally:
+        slots.release()
+
+def dispatch_update(update) -> bool:
+    """Queue the update on its chat's lane; False if that lane is full."""
+    i = update_chat_id(update) % CFG.update_workers
+    if not lane_slots[i].acquire(blocking=False):
+        return False
+    update_lanes[i].submit(process_update, update, lane_slots[i])
+    return True
 
 # -----------------------
 # Webhook route for Telegram
 # -----------------------
-@app.route(f"/{BOT_TOKEN}", methods=["POST"])
+@app.route(f"/{CFG.bot_token}", methods=["POST"])
 def receive_update():
+    # acknowledge right away; the handlers run on the update lanes
     try:
-        raw = request.get_data().decode("utf-8")
+        raw = request.get_data(cache=False)  # parsed once below; don't keep it on the request
         if not raw:
             return "OK", 200
-        update = telebot.types.Update.de_json(raw)
-        bot.process_new_updates([update])
+        # parse with orjson; de_json accepts the dict and skips its own json.loads
+        update = telebot.types.Update.de_json(orjson.loads(raw))
+        if not dispatch_update(update):
+            print("update lane full, asking Telegram to redeliver", update.update_id)
+            return "busy", 503
+    except orjson.JSONDecodeError:
+        return "bad request", 400
     except Exception:
         print("webhook processing failed:", traceback.format_exc())
     return "OK", 200
@@ -700,16 +1196,25 @@ def receive_update():
 def index():
     return "medibot running", 200
 
+def ensure_webhook():
+    # one getWebhookInfo read; setWebhook only when Telegram has something else
+    # max_connections: as many concurrent POSTs as there are update lanes (Telegram caps it at 100)
+    max_conn = min(CFG.update_workers, 100)
+    info = bot.get_webhook_info()
+    if info.url == CFG.webhook_url and info.max_connections == max_conn:
+        return "already set"
+    # setWebhook replaces any previous registration; no separate delete call needed
+    return bot.set_webhook(url=CFG.webhook_url, max_connections=max_conn)
+
 @app.route("/set_webhook", methods=["GET"])
 def set_webhook_route():
-    if WEBHOOK_MODE != "webhook":
-        return f"WEBHOOK_MODE={WEBHOOK_MODE} (not setting webhook)", 200
+    if CFG.webhook_mode != "webhook":
+        return f"WEBHOOK_MODE={CFG.webhook_mode} (not setting webhook)", 200
     try:
-        bot.remove_webhook()
-        res = bot.set_webhook(url=WEBHOOK_URL)
-        load_data()
-        reschedule_all()
-        return f"Webhook set: {WEBHOOK_URL} (resp: {res})", 200
+        # no reload here: data is loaded at startup, and a reload would drop
+        # every user's in-memory dialog state (EPHEMERAL_FIELDS)
+        res = ensure_webhook()
+        return f"Webhook set: {CFG.webhook_url} (resp: {res})", 200
     except Exception:
         return f"Failed to set webhook: {traceback.format_exc()}", 500
 
@@ -724,15 +1229,14 @@ def run_polling():
 
 def run_webhook():
     print("Starting in WEBHOOK mode")
-    bot.remove_webhook()
-    bot.set_webhook(url=WEBHOOK_URL)
+    ensure_webhook()
     load_data()
     reschedule_all()
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    serve(app, host="0.0.0.0", port=CFG.port, threads=CFG.wsgi_threads)
 
 if __name__ == "__main__":
     load_data()
-    if WEBHOOK_MODE == "webhook":
+    if CFG.webhook_mode == "webhook":
         run_webhook()
     else:
         run_polling()
@@ -0,0 +1,43 @@
+import importlib
+
+import pytest
+
+for dep in ("telebot", "flask", "apscheduler", "dotenv", "waitress", "orjson", "requests"):
+    pytest.importorskip(dep)
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    # importing the bot opens medibot.db in the cwd and needs a token
+    mp = pytest.MonkeyPatch()
+    mp.chdir(tmp_path_factory.mktemp("bot"))
+    mp.setenv("BOT_TOKEN", "123:test")
+    mp.setenv("WEBHOOK_MODE", "poll")
+    try:
+        yield importlib.import_module("medibot_final_secure")
+    finally:
+        mp.undo()
+
+
+@pytest.mark.parametrize("text, slot", [
+    ("08:30", 510),
+    ("8:30", 510),
+    ("00:00", 0),
+    ("23:59", 1439),
+    (" 9:05 ", 545),
+    ("٨:٣٠", 510),
+    ("٠٨:٣٠", 510),
+    ("٢٠:٠٠", 1200),
+])
+def test_parse_hhmm_accepts_ascii_and_arabic_indic_digits(bot, text, slot):
+    assert bot.parse_hhmm(text) == slot
+
+
+@pytest.mark.parametrize("text", ["", "8", "8:3a", "24:00", "12:60", "٢٤:٠٠", "١٢:٦٠"])
+def test_parse_hhmm_rejects_invalid_times(bot, text):
+    assert bot.parse_hhmm(text) is None
+
+
+def test_stored_arabic_indic_times_are_indexed(bot):
+    med = {"id": "m1", "اسم": "x", "الجرعة": "1", "الأوقات": ["٠٨:٠٠", "20:00"]}
+    assert bot.med_slots(med) == [480, 1200]